@@ -1,73 +1,173 @@
 import streamlit as st
 import yfinance as yf
 import pandas as pd
-from datetime import datetime
+import numpy as np
+import matplotlib
 import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # --- 页面配置 ---
 st.set_page_config(page_title="卖Put年化收益计算器", page_icon="💰", layout="wide")
 
+# --- 背景色渐变：整列向量化计算 (替代 Styler.background_gradient 的逐格计算) ---
+# 结果按 (列数据, 色板, 范围) 缓存：调滑块只要筛选结果没变，就直接复用上次算好的颜色
+@st.cache_data(show_spinner=False, max_entries=64)
+def _gradient_styles(values_bytes, cmap, vmin, vmax):
+    values = np.frombuffer(values_bytes, dtype=np.float32)
+    norm = np.clip((values - vmin) / (vmax - vmin), 0, 1)
+    rgba = matplotlib.colormaps[cmap](norm)
+
+    # 和 background_gradient 一样，根据背景亮度自动切换深/浅色文字
+    rgb = rgba[:, :3]
+    linear = np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+    luminance = linear @ np.array([0.2126, 0.7152, 0.0722])
+    text_colors = np.where(luminance < 0.408, '#f1f1f1', '#000000')
+
+    rgb_int = (rgb * 255).round().astype(int)
+    return [
+        f"background-color: #{r:02x}{g:02x}{b:02x}; color: {t}"
+        for (r, g, b), t in zip(rgb_int.tolist(), text_colors)
+    ]
+
+def _is_rate_limited(error):
+    message = str(error)
+    return "Too Many Requests" in message or "Rate limited" in message
+
 # --- 缓存函数：核心防封锁逻辑 ---
-# ttl=300 表示缓存 300秒 (5分钟)。在这5分钟内，无论怎么调参数，都不会重新请求雅虎。
+# 按数据类型分层缓存：股价变化快，到期日列表几乎不变，期权链按 (代码, 到期日) 单独缓存。
+# 这样调参数、换到期日都不会重新请求已经抓过的数据。
+@st.cache_data(ttl=60, show_spinner=False)
+def cached_price(ticker_symbol):
+    # info 只请求一次；网络错误直接抛出，交给 _with_retry 退避重试
+    info = yf.Ticker(ticker_symbol).info
+
+    # 尝试多个字段获取价格，因为有时候字段缺失
+    for key in ['currentPrice', 'regularMarketPrice', 'previousClose', 'open']:
+        val = info.get(key)
+        if val:
+            return val
+
+    # 抛异常而不是返回 None：失败结果不会被缓存，下次会重新请求
+    raise ValueError("无法获取当前股价，可能是代码错误或雅虎接口波动。")
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def cached_expirations(ticker_symbol):
+    expirations = yf.Ticker(ticker_symbol).options
+    if not expirations:
+        # 空结果不缓存 (否则要锁住一小时)，下次会重新请求
+        raise ValueError("未找到期权链数据。")
+    return expirations
+
+# 抓取单个到期日的期权链 (不缓存)，行权价按 price_anchor 的 0.25倍 到 2倍 预先裁剪
+def _load_puts(ticker_symbol, date, price_anchor):
+    puts = yf.Ticker(ticker_symbol).option_chain(date).puts
+
+    # 只保留用得到的列 (合约代码、隐含波动率等都不需要)，缓存和后续每次切片都更轻
+    # 行权价只留 0.25倍 到 2倍 参考价之间的宽区间，精确的范围筛选在缓存外按实时股价做
+    # 价格用 float32、成交量/持仓量用可空的 Int32 就足够了，数据量减半，后续计算也更快
+    puts = puts[['strike', 'bid', 'ask', 'lastPrice', 'volume', 'openInterest']]
+    puts = puts[(puts['strike'] > price_anchor * 0.25) & (puts['strike'] < price_anchor * 2)]
+    return puts.astype({
+        'strike': 'float32',
+        'bid': 'float32',
+        'ask': 'float32',
+        'lastPrice': 'float32',
+        'volume': 'Int32',
+        'openInterest': 'Int32'
+    }).sort_values('strike', ascending=False, ignore_index=True) # 行权价从高到低，缓存里就排好序
+
+# ttl=300 表示缓存 300秒 (5分钟)。抓取失败时抛出异常，异常不会被缓存，下次会重新请求。
+# 缓存键只有 (代码, 到期日)：裁剪用的参考价在缓存内部取得，并和数据一起返回，
+# 股价变动不会让缓存失效，由调用方判断缓存的行权价区间是否还够用。
 @st.cache_data(ttl=300, show_spinner=False)
+def cached_puts(ticker_symbol, date):
+    price_anchor = cached_price(ticker_symbol)
+    return _load_puts(ticker_symbol, date, price_anchor), price_anchor
+
+# --- 简单重试：网络偶发失败时按指数退避 (约 0.2s, 0.4s, ... 加随机抖动) 重试 ---
+# rate_limited 是本次抓取共用的"熔断"标志：任何一个请求遇到限流就置位，
+# 其他线程不再重试、也不再发新请求，避免继续浪费请求加重封锁。
+def _with_retry(func, *args, rate_limited, attempts=3, base_delay=0.2):
+    for attempt in range(attempts):
+        if rate_limited.is_set():
+            raise RuntimeError("Too Many Requests: 已被雅虎限流，跳过剩余请求")
+        try:
+            return func(*args)
+        except Exception as e:
+            if _is_rate_limited(e):
+                rate_limited.set()
+                raise
+            if attempt == attempts - 1:
+                raise
+            time.sleep(base_delay * 2 ** attempt * random.uniform(0.5, 1.5))
+
+# --- 单个到期日的期权链抓取 (在线程池中并发执行) ---
+def _fetch_chain(ticker_symbol, date, dte, current_price, rate_limited):
+    try:
+        puts, price_anchor = _with_retry(cached_puts, ticker_symbol, date, rate_limited=rate_limited)
+
+        # 实时股价的 0.5~1.2 倍区间超出了缓存的 0.25~2 倍区间 (股价在缓存期内大幅波动，
+        # 几乎不会发生) 时，才按实时股价单独重抓这一条，不写入缓存
+        if not (price_anchor * 0.25 <= current_price * 0.5 and current_price * 1.2 <= price_anchor * 2):
+            puts = _with_retry(_load_puts, ticker_symbol, date, current_price, rate_limited=rate_limited)
+
+        # 添加日期信息 (其余计算和筛选放到合并后的大表上统一做)
+        # 同一到期日的年化系数 365/dte 是常数，这里先算好，后面逐行计算时少一次除法
+        return puts.assign(expiration=date, dte=dte, ar_factor=np.float32(365.0 / dte))
+
+    except Exception:
+        return None # 如果某一天的数据抓取失败，跳过，继续处理其他日期
+
 def fetch_option_data(ticker_symbol):
+    rate_limited = threading.Event()
     try:
-        stock = yf.Ticker(ticker_symbol)
-        
-        # 1. 获取股价 (增加重试机制)
-        # 尝试多次获取价格，因为有时候网络波动
-        current_price = None
-        for key in ['currentPrice', 'regularMarketPrice', 'previousClose', 'open']:
-            try:
-                val = stock.info.get(key)
-                if val:
-                    current_price = val
-                    break
-            except:
-                continue
-                
-        if not current_price:
-            return None, "无法获取当前股价，可能是代码错误或雅虎接口波动。"
-
-        # 2. 获取到期日
-        expirations = stock.options
-        if not expirations:
-            return None, "未找到期权链数据。"
+        # 1. 并发获取股价和到期日 (两个请求互不依赖，没必要排队)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            price_future = executor.submit(_with_retry, cached_price, ticker_symbol, rate_limited=rate_limited)
+            expirations_future = executor.submit(_with_retry, cached_expirations, ticker_symbol, rate_limited=rate_limited)
+            current_price = price_future.result()
+            expirations = expirations_future.result()
 
         # 默认只抓取最近 3 个到期日，减少数据量，降低被封概率
         target_expirations = expirations[:3]
         
-        all_puts_raw = []
-        
-        for date in target_expirations:
-            try:
-                # 获取期权链
-                opt = stock.option_chain(date)
-                puts = opt.puts
-                
-                # 添加日期信息
-                puts['expiration'] = date
-                exp_dt = datetime.strptime(date, "%Y-%m-%d")
-                dte = (exp_dt - datetime.now()).days
-                if dte <= 0: dte = 1
-                puts['dte'] = dte
-                
-                # 预先筛选：只保留稍微靠谱的数据 (Strike 在 0.5倍 到 1.2倍股价之间)
-                # 这样可以减少后续处理的数据量
-                puts = puts[(puts['strike'] > current_price * 0.5) & (puts['strike'] < current_price * 1.2)]
-                
-                all_puts_raw.append(puts)
-                
-                # 稍微暂停 0.1 秒，温柔一点，避免被判定为攻击
-                time.sleep(0.1) 
-                
-            except Exception:
-                continue # 如果某一天的数据抓取失败，跳过，继续抓下一天
+        # 剩余天数：所有到期日一次性向量化计算，按自然日算，最少记 1 天
+        exp_dates = pd.to_datetime(list(target_expirations))
+        days = (exp_dates - pd.Timestamp.now().normalize()).days.to_numpy()
+        dte_map = dict(zip(target_expirations, np.maximum(days, 1).astype(np.int32)))
+
+        # 2. 并发抓取各到期日的期权链 (每个请求都是一次独立的网络往返，互不依赖)
+        with ThreadPoolExecutor(max_workers=len(target_expirations)) as executor:
+            results = executor.map(lambda d: _fetch_chain(ticker_symbol, d, dte_map[d], current_price, rate_limited), target_expirations)
+            all_puts_raw = [puts for puts in results if puts is not None]
 
         if not all_puts_raw:
+            if rate_limited.is_set():
+                return None, "Too Many Requests: 雅虎财经限制了访问频率，没有获取到期权数据。"
             return None, "没有获取到有效的期权数据。"
 
-        final_df = pd.concat(all_puts_raw)
+        final_df = pd.concat(all_puts_raw, ignore_index=True)
+
+        # 预先筛选：只保留稍微靠谱的数据 (Strike 在 0.5倍 到 1.2倍实时股价之间)
+        # 在缓存外、合并后的表上一次完成，股价变动不会让期权链缓存失效
+        strike = final_df['strike'].to_numpy()
+        final_df = final_df[(strike > current_price * 0.5) & (strike < current_price * 1.2)]
+
+        # 合并后统一转成 Arrow 存储：成交量/持仓量的缺失值用原生 NA 表示，切片时也更省拷贝
+        # 到期日只有几个不同取值，用分类 (字典编码) 存储，每行只占一个整数编号
+        final_df = final_df.astype({
+            'strike': 'float[pyarrow]',
+            'bid': 'float[pyarrow]',
+            'ask': 'float[pyarrow]',
+            'lastPrice': 'float[pyarrow]',
+            'volume': 'int32[pyarrow]',
+            'openInterest': 'int32[pyarrow]',
+            'expiration': 'category',
+            'dte': 'int32[pyarrow]',
+            'ar_factor': 'float[pyarrow]'
+        })
         return final_df, current_price
 
     except Exception as e:
@@ -77,22 +177,118 @@ def fetch_option_data(ticker_symbol):
 st.sidebar.header("⚙️ 参数设置")
 ticker = st.sidebar.text_input("股票代码 (美股)", value="NVDA").upper().strip()
 
-st.sidebar.subheader("💰 计算基准")
-price_basis = st.sidebar.radio(
-    "权利金价格",
-    options=["买一价 (Bid)", "最新价 (Last)", "卖一价 (Ask)"],
-    index=0
-)
-
-st.sidebar.subheader("🔍 筛选过滤")
-min_annualized_return = st.sidebar.slider("最低年化收益 (%)", 0, 100, 15)
-min_safety_margin = st.sidebar.slider("最低安全边际 (%)", 0, 50, 10)
-show_otm_only = st.sidebar.checkbox("只显示价外 (OTM)", value=True)
-
 # 强制刷新按钮
 if st.sidebar.button("🔄 强制刷新数据"):
     st.cache_data.clear()
 
+# 只刷新期权链：股价和到期日列表的缓存保留，少发两个请求
+if st.sidebar.button("🔁 只刷新期权链"):
+    cached_puts.clear()
+
+# 权利金价格选项 -> (数据列, 表格显示名)
+PRICE_COLUMNS = {
+    'Bid': ('bid', '权利金(Bid)'),
+    'Last': ('lastPrice', '权利金(Last)'),
+    'Ask': ('ask', '权利金(Ask)')
+}
+
+# --- 核心计算：年化收益、安全边际和筛选掩码 ---
+# 算术部分写进预先分配好的输出数组 (out=/原地运算)；比较运算 (strike > 0、阈值判断)
+# 仍会各自生成布尔数组。标量 100/股价 提前算好，逐行只剩乘法。
+def _filter_puts(strike, premium, ar_factor, price, min_ar, min_sm):
+    # 年化收益率%：行权价为 0 的行直接记 0，避免除零告警
+    annualized = np.zeros_like(premium)
+    np.divide(premium, strike, out=annualized, where=strike > 0)
+    annualized *= ar_factor
+    annualized *= 100.0
+
+    # 安全边际%
+    safety = np.subtract(price, strike, dtype=np.float32)
+    safety *= np.float32(100.0) / price
+
+    # 最低年化、最低安全边际合并成一个布尔掩码 (OTM 已在调用前先行筛掉)
+    mask = annualized >= min_ar
+    mask &= safety >= min_sm
+    return annualized, safety, mask
+
+# --- 计算与展示 (fragment) ---
+# 计算基准和筛选控件都放在 fragment 里：调整它们时只重跑这一块，
+# 不会重新执行数据抓取和缓存查找。fragment 里不能往侧边栏放控件，所以放在主区域。
+@st.fragment
+def _render_puts(raw_df, current_price):
+    col1, col2, col3, col4 = st.columns(4)
+    price_basis = col1.radio(
+        "💰 权利金价格",
+        options=["买一价 (Bid)", "最新价 (Last)", "卖一价 (Ask)"],
+        index=0
+    )
+    min_annualized_return = col2.slider("最低年化收益 (%)", 0, 100, 15)
+    min_safety_margin = col3.slider("最低安全边际 (%)", 0, 50, 10)
+    show_otm_only = col4.checkbox("只显示价外 (OTM)", value=True)
+
+    # --- 数据处理逻辑 (在缓存数据基础上进行计算) ---
+    # 1. 确定价格列
+    p_col, disp_col = PRICE_COLUMNS[next(k for k in PRICE_COLUMNS if k in price_basis)]
+    
+    # 2. 计算 + 3. 筛选 (所有到期日合并在一张表上，直接在 numpy 数组上一次完成)
+    # 缺失的权利金按 0 处理
+    strike = raw_df['strike'].to_numpy(np.float32)
+    premium = raw_df[p_col].to_numpy(np.float32, na_value=0.0)
+    ar_factor = raw_df['ar_factor'].to_numpy(np.float32)
+
+    # 最便宜的条件先做：只看价外时先按行权价压缩数组，后面的计算只在剩下的行上进行
+    if show_otm_only:
+        rows = np.flatnonzero(strike < current_price)
+        strike, premium, ar_factor = strike[rows], premium[rows], ar_factor[rows]
+    else:
+        rows = np.arange(len(strike))
+
+    annualized, safety, mask = _filter_puts(
+        strike, premium, ar_factor, current_price,
+        min_annualized_return, min_safety_margin
+    )
+    
+    # 切片后的新表只需补上已经算好的结果列，不用再重新计算 (raw_df 本身不会被修改)
+    df = raw_df.iloc[rows[mask]].assign(**{
+        'premium': premium[mask],
+        'Annualized Return %': annualized[mask],
+        'Safety Margin %': safety[mask],
+        'Break Even': strike[mask] - premium[mask]
+    })
+    
+    # 4. 展示
+    if not df.empty:
+        # 无需再整体排序：到期日按时间顺序拼接，每个到期日内部已按行权价从高到低排好，切片不改变顺序
+        display_cols = ['expiration', 'dte', 'strike', 'premium', 'Annualized Return %', 'Safety Margin %', 'Break Even', 'volume', 'openInterest']
+        df_disp = df[display_cols].copy()
+        df_disp.columns = ['到期日', '天数', '行权价', disp_col, '年化收益率%', '安全边际%', '盈亏平衡点', '成交量', '未平仓']
+        
+        # 价格类列整列一次性保留两位小数，渐变色缓存也因此更容易命中
+        for col in ['行权价', disp_col, '年化收益率%', '安全边际%', '盈亏平衡点']:
+            df_disp[col] = np.round(df_disp[col].to_numpy(np.float32), 2)
+        
+        # 数字格式交给 column_config 在前端渲染，Styler 只负责预先算好的背景色
+        number_format = st.column_config.NumberColumn(format="%.2f")
+        count_format = st.column_config.NumberColumn(format="%.0f")
+        st.dataframe(
+            df_disp.style
+            .apply(lambda col: _gradient_styles(col.to_numpy(np.float32).tobytes(), 'RdYlGn', 0, 50), subset=['年化收益率%'])
+            .apply(lambda col: _gradient_styles(col.to_numpy(np.float32).tobytes(), 'Blues', 0, 20), subset=['安全边际%']),
+            column_config={
+                '行权价': number_format,
+                disp_col: number_format,
+                '年化收益率%': number_format,
+                '安全边际%': number_format,
+                '盈亏平衡点': number_format,
+                '成交量': count_format,
+                '未平仓': count_format
+            },
+            height=600,
+            use_container_width=True
+        )
+    else:
+        st.warning("没有找到符合筛选条件的期权。尝试降低收益要求？")
+
 # --- 主界面 ---
 st.title("💰 美股 Put 卖方计算器 (防封版)")
 
@@ -101,70 +297,18 @@ if ticker:
         # 调用缓存函数
         raw_df, price_info = fetch_option_data(ticker)
         
-        if isinstance(price_info, str): # 如果返回的是错误信息
-            st.error(f"❌ {price_info}")
-            if "Too Many Requests" in price_info or "Rate limited" in str(price_info):
-                st.warning("⚠️ 雅虎财经限制了访问频率。建议：\n1. 等待几分钟再试。\n2. 尝试换一个冷门的股票代码测试。\n3. 如果持续报错，建议在本地电脑运行此脚本。")
-        else:
-            current_price = price_info
-            
-            # --- 数据处理逻辑 (在缓存数据基础上进行计算) ---
-            # 1. 确定价格列
-            if "Bid" in price_basis:
-                p_col = 'bid'
-                disp_col = '权利金(Bid)'
-            elif "Last" in price_basis:
-                p_col = 'lastPrice'
-                disp_col = '权利金(Last)'
-            else:
-                p_col = 'ask'
-                disp_col = '权利金(Ask)'
-            
-            df = raw_df.copy()
-            
-            # 2. 过滤 OTM
-            if show_otm_only:
-                df = df[df['strike'] < current_price]
-            
-            # 3. 计算
-            df['premium'] = df[p_col].fillna(0)
-            df['Annualized Return %'] = (df['premium'] / df['strike']) * (365 / df['dte']) * 100
-            df['Safety Margin %'] = ((current_price - df['strike']) / current_price) * 100
-            df['Break Even'] = df['strike'] - df['premium']
-            
-            # 4. 筛选
-            df = df[df['Annualized Return %'] >= min_annualized_return]
-            df = df[df['Safety Margin %'] >= min_safety_margin]
-            
-            # 5. 展示
-            col1, col2 = st.columns(2)
-            col1.metric("当前股价", f"${current_price:.2f}")
-            col2.caption(f"数据缓存已开启。如需最新数据，请点击左侧'强制刷新'。")
-            
-            if not df.empty:
-                df = df.sort_values(by=['expiration', 'strike'], ascending=[True, False])
-                
-                display_cols = ['expiration', 'dte', 'strike', 'premium', 'Annualized Return %', 'Safety Margin %', 'Break Even', 'volume', 'openInterest']
-                df_disp = df[display_cols].copy()
-                df_disp.columns = ['到期日', '天数', '行权价', disp_col, '年化收益率%', '安全边际%', '盈亏平衡点', '成交量', '未平仓']
-                
-                st.dataframe(
-                    df_disp.style
-                    .format({
-                        '行权价': '{:.2f}', 
-                        disp_col: '{:.2f}', 
-                        '年化收益率%': '{:.2f}', 
-                        '安全边际%': '{:.2f}',
-                        '盈亏平衡点': '{:.2f}',
-                        '成交量': '{:.0f}',
-                        '未平仓': '{:.0f}'
-                    })
-                    .background_gradient(subset=['年化收益率%'], cmap='RdYlGn', vmin=0, vmax=50)
-                    .background_gradient(subset=['安全边际%'], cmap='Blues', vmin=0, vmax=20),
-                    height=600,
-                    use_container_width=True
-                )
-            else:
-                st.warning("没有找到符合筛选条件的期权。尝试降低收益要求？")
+    if isinstance(price_info, str): # 如果返回的是错误信息
+        st.error(f"❌ {price_info}")
+        if "Too Many Requests" in price_info or "Rate limited" in str(price_info):
+            st.warning("⚠️ 雅虎财经限制了访问频率。建议：\n1. 等待几分钟再试。\n2. 尝试换一个冷门的股票代码测试。\n3. 如果持续报错，建议在本地电脑运行此脚本。")
+    else:
+        # 转成 float32，和行权价列保持同一精度，避免比较和计算时被提升成 float64
+        current_price = np.float32(price_info)
+        
+        col1, col2 = st.columns(2)
+        col1.metric("当前股价", f"${current_price:.2f}")
+        col2.caption(f"数据缓存已开启。如需最新数据，请点击左侧'强制刷新'。")
+        
+        _render_puts(raw_df, current_price)
 else:
     st.info("👈 请在左侧输入代码")